@@ -3,7 +3,8 @@ import { ConvexHttpClient } from "convex/browser";
 import { api } from "@/convex/_generated/api";
 import { Id } from "@/convex/_generated/dataModel";
 import Anthropic from "@anthropic-ai/sdk";
-import { PlaywrightCrawler } from "crawlee";
+import { PlaywrightCrawler, RequestQueue, playwrightUtils } from "crawlee";
+import * as cheerio from "cheerio";
 import archiver from "archiver";
 import * as fs from "fs";
 import * as path from "path";
@@ -11,9 +12,190 @@ import * as os from "os";
 
 const convex = new ConvexHttpClient(process.env.NEXT_PUBLIC_CONVEX_URL!);
 
+// Retire a browser after it has served this many pages so long crawls don't
+// accumulate Chromium's native memory drift
+const BROWSER_POOL_RECYCLE_AFTER = parseInt(
+  process.env.BROWSER_POOL_RECYCLE_AFTER || "100"
+);
+
+// Pages open at once per crawl, and crawls allowed to run at once per server
+// instance; together they bound how many renderers share the CPU
+const CRAWL_CONCURRENCY = parseInt(process.env.CRAWL_CONCURRENCY || "2");
+const MAX_CONCURRENT_CRAWLS = parseInt(
+  process.env.MAX_CONCURRENT_CRAWLS || "2"
+);
+
+// How many crawls may wait for a slot, and for how long, before the route
+// gives up; keeps queued jobs well inside the calling Convex action's limit
+const MAX_QUEUED_CRAWLS = parseInt(process.env.MAX_QUEUED_CRAWLS || "4");
+const CRAWL_QUEUE_TIMEOUT_MS = parseInt(
+  process.env.CRAWL_QUEUE_TIMEOUT_MS || "60000"
+);
+
+// Per-operation cap for Playwright calls and asset downloads, and a wall-clock
+// budget for a whole crawl so hostile sites can't hold a server instance
+const PAGE_OP_TIMEOUT_MS = parseInt(process.env.PAGE_OP_TIMEOUT_MS || "8000");
+const CRAWL_DEADLINE_MS = parseInt(process.env.CRAWL_DEADLINE_MS || "120000");
+const NAVIGATION_TIMEOUT_MS = 15000;
+
+// Assets downloaded per page. They are fetched in parallel under one
+// PAGE_OP_TIMEOUT_MS budget, so a page handler stays well inside Crawlee's
+// default 60s, and never longer than the crawl budget itself
+const MAX_CSS_PER_PAGE = 5;
+const MAX_IMAGES_PER_PAGE = 10;
+const REQUEST_HANDLER_TIMEOUT_SECS = Math.min(
+  60,
+  Math.ceil(CRAWL_DEADLINE_MS / 1000)
+);
+
+let activeCrawls = 0;
+const crawlQueue: Array<() => void> = [];
+
+// Raised when no crawl slot is available; the route answers 503
+class CrawlBusyError extends Error {}
+
+// Helper: Wait for a free crawl slot, calling onQueued if the job has to wait
+async function acquireCrawlSlot(onQueued: () => Promise<unknown>) {
+  if (activeCrawls < MAX_CONCURRENT_CRAWLS) {
+    activeCrawls++;
+    return;
+  }
+  if (crawlQueue.length >= MAX_QUEUED_CRAWLS) {
+    throw new CrawlBusyError(
+      "Crawler is busy: too many mirror jobs are queued, please try again shortly"
+    );
+  }
+
+  // The releasing crawl hands its slot straight to the next waiter
+  let grantSlot!: () => void;
+  const slot = new Promise<void>((resolve) => (grantSlot = resolve));
+  crawlQueue.push(grantSlot);
+
+  let timer: NodeJS.Timeout | undefined;
+  try {
+    await onQueued();
+    await Promise.race([
+      slot,
+      new Promise<never>((_, reject) => {
+        timer = setTimeout(
+          () =>
+            reject(
+              new CrawlBusyError(
+                `Crawler is busy: no crawl slot freed up within ${CRAWL_QUEUE_TIMEOUT_MS}ms`
+              )
+            ),
+          CRAWL_QUEUE_TIMEOUT_MS
+        );
+      }),
+    ]);
+  } catch (error) {
+    // Leave the queue, or pass on a slot that was granted as we gave up
+    const index = crawlQueue.indexOf(grantSlot);
+    if (index !== -1) {
+      crawlQueue.splice(index, 1);
+    } else {
+      releaseCrawlSlot();
+    }
+    throw error;
+  } finally {
+    clearTimeout(timer);
+  }
+}
+
+// Helper: Release a crawl slot to the next queued crawl
+function releaseCrawlSlot() {
+  const next = crawlQueue.shift();
+  if (next) {
+    next();
+  } else {
+    activeCrawls--;
+  }
+}
+
+// Image, font and media URLs the renderer never needs: image URLs are read from
+// the HTML snapshot and downloaded separately, so the page can skip them.
+// Crawlee matches these as substrings anywhere in the URL, so keep to
+// extensions unlikely to appear inside script or stylesheet names
+const BLOCKED_URL_PATTERNS = [
+  ".jpg",
+  ".jpeg",
+  ".png",
+  ".gif",
+  ".webp",
+  ".avif",
+  ".svg",
+  ".woff",
+  ".woff2",
+  ".ttf",
+  ".otf",
+  ".mp4",
+  ".webm",
+  ".mp3",
+];
+
+// Homepage patterns used by the AI analysis, compiled once at module load
+const TITLE_RE = /<title[^>]*>([^<]+)<\/title>/i;
+const HREF_RE = /href=["']([^"']+)["']/gi;
+
+// Headless Chromium flags that skip GPU init and background work
+const CHROMIUM_ARGS = [
+  "--disable-gpu",
+  "--disable-dev-shm-usage",
+  "--no-first-run",
+  "--disable-background-networking",
+  "--disable-extensions",
+  "--mute-audio",
+  "--disable-renderer-backgrounding",
+  "--disable-backgrounding-occluded-windows",
+  "--disable-blink-features=AutomationControlled",
+];
+
+// Anthropic client shared across requests so warm server instances reuse its
+// keep-alive connections instead of re-handshaking on every crawl
+let anthropicClient: Anthropic | null = null;
+
+function getAnthropic() {
+  if (!anthropicClient) {
+    anthropicClient = new Anthropic({
+      apiKey: process.env.ANTHROPIC_API_KEY,
+    });
+  }
+  return anthropicClient;
+}
+
+// Recent AI analyses keyed by URL, so re-mirroring the same site within the
+// TTL skips the homepage fetch and the Claude call
+const ANALYSIS_CACHE_TTL_MS = parseInt(
+  process.env.ANALYSIS_CACHE_TTL_MS || "600000"
+);
+const ANALYSIS_CACHE_MAX_ENTRIES = 100;
+
+// Shape of the AI analysis, matching siteMirror.updateAnalysis
+type SiteAnalysis = {
+  siteType: string;
+  estimatedPages: number;
+  navigationStructure: string[];
+  priorityPages: string[];
+  crawlStrategy: string;
+  challenges: string[];
+  techStack?: string[];
+};
+
+const analysisCache = new Map<string, { ts: number; analysis: SiteAnalysis }>();
+
 // Helper: Analyze website with AI
-async function analyzeWebsite(url: string) {
+async function analyzeWebsite(
+  url: string
+): Promise<{ analysis: SiteAnalysis; cached: boolean }> {
   try {
+    // Normalize so equivalent spellings of a URL share one entry
+    const cacheKey = new URL(url).href;
+    const cached = analysisCache.get(cacheKey);
+    if (cached && Date.now() - cached.ts < ANALYSIS_CACHE_TTL_MS) {
+      console.log(`Using cached analysis for ${url}`);
+      return { analysis: cached.analysis, cached: true };
+    }
+
     // Fetch homepage
     const response = await fetch(url, {
       headers: {
@@ -28,11 +210,11 @@ async function analyzeWebsite(url: string) {
     const html = await response.text();
 
     // Extract basic info
-    const titleMatch = html.match(/<title[^>]*>([^<]+)<\/title>/i);
+    const titleMatch = html.match(TITLE_RE);
     const title = titleMatch ? titleMatch[1] : "Untitled";
 
     // Extract links
-    const linkMatches = html.matchAll(/href=["']([^"']+)["']/gi);
+    const linkMatches = html.matchAll(HREF_RE);
     const links: string[] = [];
     for (const match of linkMatches) {
       try {
@@ -44,10 +226,7 @@ async function analyzeWebsite(url: string) {
     }
     const uniqueLinks = Array.from(new Set(links)).slice(0, 50);
 
-    // Initialize Anthropic client
-    const anthropic = new Anthropic({
-      apiKey: process.env.ANTHROPIC_API_KEY,
-    });
+    const anthropic = getAnthropic();
 
     // Create AI analysis prompt
     const prompt = `Analyze this website and provide a structured analysis for intelligent web crawling.
@@ -84,8 +263,16 @@ Respond ONLY with valid JSON, no other text.`;
       throw new Error("Unexpected response type from AI");
     }
 
-    const analysis = JSON.parse(content.text);
-    return analysis;
+    const analysis: SiteAnalysis = JSON.parse(content.text);
+
+    // Map keeps insertion order, so the first key is the oldest entry
+    analysisCache.delete(cacheKey);
+    if (analysisCache.size >= ANALYSIS_CACHE_MAX_ENTRIES) {
+      analysisCache.delete(analysisCache.keys().next().value!);
+    }
+    analysisCache.set(cacheKey, { ts: Date.now(), analysis });
+
+    return { analysis, cached: false };
   } catch (error) {
     console.error("Analysis error:", error);
     throw new Error(
@@ -94,8 +281,36 @@ Respond ONLY with valid JSON, no other text.`;
   }
 }
 
+// Helper: Resolve the document base URL the way the DOM's .href/.src do,
+// honouring <base href> and falling back to the page URL
+function resolveDocumentBase($: cheerio.CheerioAPI, pageUrl: string) {
+  try {
+    return new URL($("base[href]").attr("href") ?? "", pageUrl).href;
+  } catch {
+    return pageUrl;
+  }
+}
+
+// Helper: Collect absolute stylesheet and image URLs in a single traversal
+function collectAssetUrls($: cheerio.CheerioAPI, baseUrl: string) {
+  const cssLinks: string[] = [];
+  const images: string[] = [];
+  $('link[rel="stylesheet"][href], img[src]').each((_, el) => {
+    const isImage = el.tagName === "img";
+    const value = $(el).attr(isImage ? "src" : "href");
+    if (!value) return;
+    try {
+      (isImage ? images : cssLinks).push(new URL(value, baseUrl).href);
+    } catch {
+      // Invalid URL, skip
+    }
+  });
+  return { cssLinks, images };
+}
+
 // Helper: Crawl website with Playwright
-async function crawlWebsite(
+async function runCrawl(
+  requestQueue: RequestQueue,
   url: string,
   priorityPages: string[],
   maxPages: number
@@ -108,26 +323,70 @@ async function crawlWebsite(
     totalAssets: 0,
     totalSize: 0,
     startTime: Date.now(),
+    deadlineExceeded: false,
   };
 
   const visitedUrls = new Set<string>();
   const baseUrl = new URL(url);
 
+  // Set when the crawler starts. Timeouts are clipped to what is left of the
+  // crawl budget, so pages still in flight at the deadline can't outlive it
+  let deadlineAt = Infinity;
+  const budgetMs = (ms: number) =>
+    Math.max(1, Math.min(ms, deadlineAt - Date.now()));
+
   const crawler = new PlaywrightCrawler({
+    requestQueue,
     maxRequestsPerCrawl: maxPages,
-    maxConcurrency: 2,
+    maxConcurrency: CRAWL_CONCURRENCY,
+    // Keep tabs per browser at the crawl's concurrency (Crawlee allows 20) and
+    // make its 100-page browser retirement tunable
+    browserPoolOptions: {
+      maxOpenPagesPerBrowser: CRAWL_CONCURRENCY,
+      retireBrowserAfterPageCount: BROWSER_POOL_RECYCLE_AFTER,
+    },
+    launchContext: {
+      launchOptions: {
+        // With no channel set, Playwright serves headless launches from the
+        // lightweight chromium-headless-shell build rather than full Chromium
+        headless: true,
+        args: CHROMIUM_ARGS,
+      },
+    },
+    navigationTimeoutSecs: NAVIGATION_TIMEOUT_MS / 1000,
+    requestHandlerTimeoutSecs: REQUEST_HANDLER_TIMEOUT_SECS,
+    preNavigationHooks: [
+      async ({ page }, gotoOptions) => {
+        // networkidle never settles on pages with trackers or long-polling,
+        // so resolve navigation at DOMContentLoaded instead
+        if (gotoOptions) {
+          gotoOptions.waitUntil = "domcontentloaded";
+          gotoOptions.timeout = budgetMs(NAVIGATION_TIMEOUT_MS);
+        }
+        page.setDefaultTimeout(budgetMs(PAGE_OP_TIMEOUT_MS));
+
+        // Blocks through CDP, unlike page.route, so the HTTP cache stays on
+        // and shared CSS/JS isn't re-downloaded for every page
+        await playwrightUtils.blockRequests(page, {
+          urlPatterns: BLOCKED_URL_PATTERNS,
+        });
+      },
+    ],
     async requestHandler({ page, request, enqueueLinks }) {
       const currentUrl = request.url;
 
       // Skip if already visited
       if (visitedUrls.has(currentUrl)) return;
-      visitedUrls.add(currentUrl);
 
       console.log(`Crawling: ${currentUrl}`);
 
       try {
-        // Wait for page load
-        await page.waitForLoadState("networkidle", { timeout: 15000 });
+        // Best-effort settle: wait for load, then allow a short idle window so
+        // client-rendered content exists without hanging on busy pages
+        await page.waitForLoadState("load").catch(() => {});
+        await page
+          .waitForLoadState("networkidle", { timeout: budgetMs(2000) })
+          .catch(() => {});
 
         // Get page content
         const html = await page.content();
@@ -141,47 +400,63 @@ async function crawlWebsite(
         stats.pagesDownloaded++;
         stats.totalSize += html.length;
 
-        // Download CSS files
-        const cssLinks = await page.$$eval('link[rel="stylesheet"]', (links) =>
-          links.map((link) => (link as HTMLLinkElement).href)
+        // Parse the snapshot server-side instead of round-tripping each
+        // query through the browser
+        const $ = cheerio.load(html);
+        const { cssLinks, images } = collectAssetUrls(
+          $,
+          resolveDocumentBase($, page.url())
         );
 
-        for (const cssUrl of cssLinks.slice(0, 5)) {
-          try {
-            const response = await page.context().request.get(cssUrl);
-            const cssContent = await response.text();
-            const cssFileName = path.basename(new URL(cssUrl).pathname) || "style.css";
-            fs.writeFileSync(path.join(outputDir, cssFileName), cssContent);
-            stats.totalAssets++;
-            stats.totalSize += cssContent.length;
-          } catch (e) {
-            console.log(`Failed to download CSS: ${cssUrl}`);
-          }
+        // Once the budget is spent keep the saved HTML but skip its assets
+        // and link discovery; the crawler is already stopping
+        if (Date.now() >= deadlineAt) {
+          stats.deadlineExceeded = true;
+          return;
         }
 
-        // Download images
-        const images = await page.$$eval("img[src]", (imgs) =>
-          imgs.map((img) => (img as HTMLImageElement).src)
-        );
-
-        for (const imgUrl of images.slice(0, 10)) {
-          try {
-            const response = await page.context().request.get(imgUrl);
-            const buffer = await response.body();
-            const imgFileName = path.basename(new URL(imgUrl).pathname) || "image.jpg";
-            fs.writeFileSync(path.join(outputDir, imgFileName), buffer);
-            stats.totalAssets++;
-            stats.totalSize += buffer.length;
-          } catch (e) {
-            console.log(`Failed to download image: ${imgUrl}`);
-          }
-        }
+        // Download CSS files and images in parallel under one time budget
+        const assetTimeout = budgetMs(PAGE_OP_TIMEOUT_MS);
+        await Promise.allSettled([
+          ...cssLinks.slice(0, MAX_CSS_PER_PAGE).map(async (cssUrl) => {
+            try {
+              const response = await page.context().request.get(cssUrl, {
+                timeout: assetTimeout,
+              });
+              const cssContent = await response.text();
+              const cssFileName = path.basename(new URL(cssUrl).pathname) || "style.css";
+              fs.writeFileSync(path.join(outputDir, cssFileName), cssContent);
+              stats.totalAssets++;
+              stats.totalSize += cssContent.length;
+            } catch (e) {
+              console.log(`Failed to download CSS: ${cssUrl}`);
+            }
+          }),
+          ...images.slice(0, MAX_IMAGES_PER_PAGE).map(async (imgUrl) => {
+            try {
+              const response = await page.context().request.get(imgUrl, {
+                timeout: assetTimeout,
+              });
+              const buffer = await response.body();
+              const imgFileName = path.basename(new URL(imgUrl).pathname) || "image.jpg";
+              fs.writeFileSync(path.join(outputDir, imgFileName), buffer);
+              stats.totalAssets++;
+              stats.totalSize += buffer.length;
+            } catch (e) {
+              console.log(`Failed to download image: ${imgUrl}`);
+            }
+          }),
+        ]);
 
         // Enqueue same-domain links
         await enqueueLinks({
           globs: [`${baseUrl.origin}/**`],
           exclude: [/\.(pdf|zip|exe|dmg)$/],
         });
+
+        // Only mark visited once the page is fully handled, so a retry after
+        // a handler timeout does the work again
+        visitedUrls.add(currentUrl);
       } catch (error) {
         console.error(`Error crawling ${currentUrl}:`, error);
       }
@@ -193,14 +468,56 @@ async function crawlWebsite(
     await crawler.addRequests([pageUrl]);
   }
 
-  // Run crawler
-  await crawler.run();
+  // Run crawler, stopping once its budget is spent; pages saved so far are kept
+  deadlineAt = Date.now() + CRAWL_DEADLINE_MS;
+  const deadline = setTimeout(() => {
+    console.log(`Crawl deadline exceeded after ${CRAWL_DEADLINE_MS}ms`);
+    stats.deadlineExceeded = true;
+    crawler.stop("deadline_exceeded");
+  }, CRAWL_DEADLINE_MS);
+  try {
+    await crawler.run();
+  } finally {
+    clearTimeout(deadline);
+  }
 
   stats.totalSize = Math.round(stats.totalSize / 1024); // Convert to KB
 
   return { outputDir, stats };
 }
 
+// Helper: Crawl website once a crawl slot is free, in a job-private queue
+async function crawlWebsite(
+  jobId: string,
+  url: string,
+  priorityPages: string[],
+  maxPages: number
+) {
+  // Take the slot before anything is queued, and keep each job's URLs in its
+  // own queue so waiting or stopped crawls can't leak pages into another job
+  await acquireCrawlSlot(() =>
+    convex.mutation(api.siteMirror.updateJobStatus, {
+      jobId: jobId as Id<"mirrorJobs">,
+      status: "crawling",
+      currentPhase: "Queued: waiting for a free crawler...",
+    })
+  );
+  let requestQueue: RequestQueue | undefined;
+  try {
+    await convex.mutation(api.siteMirror.updateJobStatus, {
+      jobId: jobId as Id<"mirrorJobs">,
+      status: "crawling",
+      currentPhase: "Crawling website with Playwright...",
+    });
+
+    requestQueue = await RequestQueue.open(`mirror-${jobId}`);
+    return await runCrawl(requestQueue, url, priorityPages, maxPages);
+  } finally {
+    await requestQueue?.drop();
+    releaseCrawlSlot();
+  }
+}
+
 // Helper: Create ZIP archive
 async function createArchive(sourceDir: string): Promise<Buffer> {
   return new Promise((resolve, reject) => {
@@ -231,7 +548,8 @@ export async function POST(request: NextRequest) {
     });
 
     // Call AI analysis service
-    const analysis = await analyzeWebsite(url);
+    const { analysis, cached: analysisCached } = await analyzeWebsite(url);
+    const aiAnalyses = analysisCached ? 0 : 1;
 
     await convex.mutation(api.siteMirror.updateAnalysis, {
       jobId: jobId as Id<"mirrorJobs">,
@@ -261,17 +579,11 @@ export async function POST(request: NextRequest) {
       crawlPlan: crawlPlan,
     });
 
-    // Update status to crawling
-    await convex.mutation(api.siteMirror.updateJobStatus, {
-      jobId: jobId as Id<"mirrorJobs">,
-      status: "crawling",
-      currentPhase: "Crawling website with Playwright...",
-    });
-
-    // Execute actual crawl
+    // Execute actual crawl; status moves to crawling once a slot is free
     const maxPages = parseInt(process.env.MAX_PAGES_PER_CRAWL || "50");
 
     const { outputDir, stats: crawlStats } = await crawlWebsite(
+      jobId,
       url,
       analysis.priorityPages,
       maxPages
@@ -279,28 +591,28 @@ export async function POST(request: NextRequest) {
 
     const duration = Date.now() - crawlStats.startTime;
 
-    // Update crawl statistics
-    await convex.mutation(api.siteMirror.updateStats, {
-      jobId: jobId as Id<"mirrorJobs">,
-      stats: {
-        pagesDownloaded: crawlStats.pagesDownloaded,
-        totalAssets: crawlStats.totalAssets,
-        totalSize: crawlStats.totalSize,
-        duration: duration,
-        aiAnalyses: 1,
-        adaptations: 0,
-      },
-    });
-
-    // Update status to processing
-    await convex.mutation(api.siteMirror.updateJobStatus, {
-      jobId: jobId as Id<"mirrorJobs">,
-      status: "processing",
-      currentPhase: "Creating ZIP file...",
-    });
-
-    // Create ZIP and save to public directory for download
-    const zipBuffer = await createArchive(outputDir);
+    // Report stats and the processing phase while the ZIP is built; neither
+    // mutation feeds the archive, so they stay off the critical path
+    const [, , zipBuffer] = await Promise.all([
+      convex.mutation(api.siteMirror.updateStats, {
+        jobId: jobId as Id<"mirrorJobs">,
+        stats: {
+          pagesDownloaded: crawlStats.pagesDownloaded,
+          totalAssets: crawlStats.totalAssets,
+          totalSize: crawlStats.totalSize,
+          duration: duration,
+          aiAnalyses,
+          adaptations: 0,
+        },
+      }),
+      convex.mutation(api.siteMirror.updateJobStatus, {
+        jobId: jobId as Id<"mirrorJobs">,
+        status: "processing",
+        currentPhase: "Creating ZIP file...",
+      }),
+      // Create ZIP and save to public directory for download
+      createArchive(outputDir),
+    ]);
 
     // Save ZIP to public/downloads directory
     const publicDir = path.join(process.cwd(), "public", "downloads");
@@ -321,12 +633,15 @@ export async function POST(request: NextRequest) {
     await convex.mutation(api.siteMirror.completeJob, {
       jobId: jobId as Id<"mirrorJobs">,
       downloadUrl: downloadUrl,
+      currentPhase: crawlStats.deadlineExceeded
+        ? "Mirror completed with partial results (crawl deadline exceeded)"
+        : undefined,
       stats: {
         pagesDownloaded: crawlStats.pagesDownloaded,
         totalAssets: crawlStats.totalAssets,
         totalSize: crawlStats.totalSize,
         duration: duration,
-        aiAnalyses: 1,
+        aiAnalyses,
         adaptations: 0,
       },
     });
@@ -358,7 +673,7 @@ export async function POST(request: NextRequest) {
         success: false,
         error: error instanceof Error ? error.message : "Unknown error",
       },
-      { status: 500 }
+      { status: error instanceof CrawlBusyError ? 503 : 500 }
     );
   }
 }
@@ -146,6 +146,7 @@ export const completeJob = mutation({
   args: {
     jobId: v.id("mirrorJobs"),
     downloadUrl: v.string(),
+    currentPhase: v.optional(v.string()),
     stats: v.object({
       pagesDownloaded: v.number(),
       totalAssets: v.number(),
@@ -158,7 +159,7 @@ export const completeJob = mutation({
   handler: async (ctx, args) => {
     await ctx.db.patch(args.jobId, {
       status: "completed",
-      currentPhase: "Mirror completed successfully!",
+      currentPhase: args.currentPhase ?? "Mirror completed successfully!",
       downloadUrl: args.downloadUrl,
       stats: args.stats,
       updatedAt: Date.now(),